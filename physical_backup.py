@@ -0,0 +1,527 @@
+import os
+import re
+import json
+import time
+import zlib
+import logging
+import tarfile
+import tempfile
+import threading
+import subprocess
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+import psycopg2
+from utils import (
+    DATA_DIR,
+    BACKUPS_DIR,
+    BACKUP_MODE_PHYSICAL,
+    PartWriter,
+    parse_db_url,
+    get_upload_target,
+    update_last_run
+)
+
+logger = logging.getLogger(__name__)
+
+WAL_DIR = os.path.join(DATA_DIR, 'wal')
+PHYSICAL_INDEX_FILE = os.path.join(DATA_DIR, 'physical_index.json')
+
+# Base backups are split into parts below the Telegram bot upload limit
+BASEBACKUP_PART_SIZE = int(os.getenv("BASEBACKUP_PART_SIZE_MB", "1900")) * 1024 * 1024
+# WAL segments are bundled once they reach this size or this age
+WAL_BUNDLE_SIZE = int(os.getenv("WAL_BUNDLE_SIZE_MB", "64")) * 1024 * 1024
+WAL_BUNDLE_INTERVAL = int(os.getenv("WAL_BUNDLE_INTERVAL", "300"))
+WAL_POLL_INTERVAL = 10
+WAL_SEGMENT_SIZE = 16 * 1024 * 1024
+CHUNK_SIZE = 1024 * 1024
+
+WAL_SEGMENT_RE = re.compile(r'^[0-9A-F]{24}$')
+WAL_HISTORY_RE = re.compile(r'^[0-9A-F]{8}\.history$')
+START_POINT_RE = re.compile(r'write-ahead log start point: ([0-9A-F]+)/([0-9A-F]+) on timeline (\d+)')
+END_POINT_RE = re.compile(r'write-ahead log end point: ([0-9A-F]+/[0-9A-F]+)')
+
+_index_lock = threading.Lock()
+_archivers = {}
+_archivers_lock = threading.Lock()
+
+
+def load_physical_index():
+    """Load the base backup and WAL bundle index"""
+    try:
+        with open(PHYSICAL_INDEX_FILE, 'r') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {"connections": {}}
+
+def _add_index_entry(connection_id, kind, entry):
+    """Append an entry to base_backups or wal_bundles of a connection"""
+    with _index_lock:
+        index = load_physical_index()
+        conn_index = index["connections"].setdefault(
+            connection_id, {"base_backups": [], "wal_bundles": []}
+        )
+        conn_index[kind].append(entry)
+        os.makedirs(DATA_DIR, exist_ok=True)
+        with open(PHYSICAL_INDEX_FILE, 'w') as f:
+            json.dump(index, f, indent=4)
+
+def _message_location(message):
+    """Return the chat and message id of an uploaded file, if known"""
+    if message is None:
+        return None, None
+    return message.chat.id, message.id
+
+def lsn_to_segment(timeline, lsn_high, lsn_low):
+    """Return the WAL segment file name containing an LSN"""
+    return f"{timeline:08X}{lsn_high:08X}{lsn_low // WAL_SEGMENT_SIZE:08X}"
+
+def plan_recovery(connection_id, target_time=None):
+    """Find the base backup and WAL bundles needed to recover to target_time.
+
+    target_time uses the '%Y-%m-%dT%H:%M:%S' format, None means latest.
+    Returns a (base_backup, wal_bundles) tuple.
+    """
+    conn_index = load_physical_index()["connections"].get(connection_id)
+    if not conn_index or not conn_index["base_backups"]:
+        raise Exception("No base backup found for this connection")
+
+    base_backups = [
+        b for b in conn_index["base_backups"]
+        if target_time is None or b["finished_at"] <= target_time
+    ]
+    if not base_backups:
+        raise Exception(f"No base backup finished before {target_time}")
+
+    def bundles_from(base_backup):
+        # Compare log/segment numbers only, so timeline switches don't drop bundles
+        start = base_backup["start_segment"][8:]
+        return [
+            bundle for bundle in conn_index["wal_bundles"]
+            if not bundle["last_segment"] or bundle["last_segment"][8:] >= start
+        ]
+
+    if target_time is None:
+        # A base backup is only consistent once WAL up to its end point has
+        # been replayed, so take the newest one whose end segment is uploaded
+        uploaded = max(
+            (bundle["last_segment"][8:] for bundle in conn_index["wal_bundles"] if bundle["last_segment"]),
+            default=None
+        )
+        for base_backup in reversed(base_backups):
+            end_segment = base_backup["start_segment"]
+            if base_backup.get("end_lsn"):
+                lsn_high, lsn_low = base_backup["end_lsn"].split('/')
+                end_segment = lsn_to_segment(base_backup["timeline"], int(lsn_high, 16), int(lsn_low, 16))
+            if uploaded is not None and uploaded >= end_segment[8:]:
+                return base_backup, bundles_from(base_backup)
+
+        last_write_at = max(
+            (bundle["last_write_at"] for bundle in conn_index["wal_bundles"] if bundle.get("last_write_at")),
+            default=None
+        )
+        raise Exception(
+            f"WAL up to the end of {base_backups[-1]['name']} has not been uploaded yet, "
+            f"the latest uploaded WAL was written at {last_write_at}"
+        )
+
+    base_backup = base_backups[-1]
+    candidates = bundles_from(base_backup)
+
+    # Take every bundle with WAL written up to the target time. Bundles
+    # indexed before first_write_at was recorded are always taken.
+    wal_bundles = []
+    for position, bundle in enumerate(candidates):
+        first_write_at = bundle.get("first_write_at")
+        if first_write_at and first_write_at > target_time:
+            # One more bundle as margin for second-level timestamps
+            wal_bundles.append(bundle)
+            return base_backup, wal_bundles
+        wal_bundles.append(bundle)
+
+    last_write_at = max(
+        (bundle["last_write_at"] for bundle in wal_bundles if bundle.get("last_write_at")),
+        default=None
+    )
+    if last_write_at is None or last_write_at < target_time:
+        raise Exception(
+            f"WAL up to {target_time} has not been uploaded yet, "
+            f"the latest uploaded WAL was written at {last_write_at}"
+        )
+    return base_backup, wal_bundles
+
+
+def _discard_uploaded_parts(telegram_uploader, connection, uploads):
+    """Delete the parts of a failed base backup that already reached Telegram"""
+    parts = [
+        upload.result() for upload in uploads
+        if upload.done() and not upload.exception()
+    ]
+    messages = {}
+    for part in parts:
+        if part["message_id"] is not None:
+            messages.setdefault(part["chat_id"], []).append(part["message_id"])
+    for chat_id, message_ids in messages.items():
+        logger.warning(
+            f"Deleting {len(message_ids)} uploaded parts of the failed base backup "
+            f"for {connection['name']} from chat {chat_id}"
+        )
+        try:
+            telegram_uploader.sender.submit(
+                telegram_uploader.client.delete_messages,
+                chat_id,
+                message_ids=message_ids
+            )
+        except Exception as e:
+            logger.error(f"Could not delete parts {message_ids} in chat {chat_id}: {e}")
+
+def basebackup_database(connection, telegram_uploader, default_chat_id):
+    """Stream a compressed pg_basebackup of a connection to Telegram"""
+    try:
+        db_info = parse_db_url(connection['db_url'])
+        started_at = datetime.now().strftime('%Y-%m-%dT%H:%M:%S')
+        backup_name = f"{connection['name']}_base_{started_at}"
+        chat_id, reply_to, added_by = get_upload_target(connection, default_chat_id)
+
+        os.makedirs(BACKUPS_DIR, exist_ok=True)
+        with tempfile.TemporaryDirectory(dir=BACKUPS_DIR) as temp_dir:
+            env = os.environ.copy()
+            env['PGPASSWORD'] = db_info['password']
+
+            # WAL is archived separately by pg_receivewal, so -X none
+            pg_basebackup_cmd = [
+                'pg_basebackup',
+                '-h', db_info['host'],
+                '-p', str(db_info['port']),
+                '-U', db_info['user'],
+                '-D', '-',
+                '-F', 't',
+                '-X', 'none',
+                '-c', 'fast',
+                '-v'
+            ]
+
+            # At most one finished part waits for upload. When uploads fall
+            # behind, on_part blocks, the pipe fills up and pg_basebackup waits.
+            pending_upload = threading.Semaphore(1)
+
+            def upload_part(path, number):
+                try:
+                    message = telegram_uploader.upload_file(
+                        path,
+                        chat_id,
+                        caption=f"Base backup for {connection['name']} started at {started_at} (part {number})",
+                        reply_to_message_id=reply_to,
+                        added_by=added_by
+                    )
+                    part_chat_id, message_id = _message_location(message)
+                    part = {
+                        "file": os.path.basename(path),
+                        "size": os.path.getsize(path),
+                        "chat_id": part_chat_id,
+                        "message_id": message_id
+                    }
+                    os.remove(path)
+                    return part
+                finally:
+                    pending_upload.release()
+
+            def on_part(path, number):
+                pending_upload.acquire()
+                # Stop streaming as soon as an earlier part failed to upload
+                for upload in uploads:
+                    if upload.done() and upload.exception():
+                        raise upload.exception()
+                uploads.append(executor.submit(upload_part, path, number))
+
+            logger.info(f"Starting base backup for database: {connection['name']}")
+            stderr_path = os.path.join(temp_dir, 'pg_basebackup.log')
+            uploads = []
+            process = None
+            try:
+                # Parts are uploaded in the background so the stream keeps flowing
+                with open(stderr_path, 'w') as stderr_file, ThreadPoolExecutor(max_workers=1) as executor:
+                    writer = PartWriter(
+                        os.path.join(temp_dir, f"{backup_name}.tar.gz"),
+                        BASEBACKUP_PART_SIZE,
+                        on_part
+                    )
+                    try:
+                        process = subprocess.Popen(
+                            pg_basebackup_cmd,
+                            env=env,
+                            stdout=subprocess.PIPE,
+                            stderr=stderr_file
+                        )
+                        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+                        for chunk in iter(lambda: process.stdout.read(CHUNK_SIZE), b''):
+                            writer.write(compressor.compress(chunk))
+                        writer.write(compressor.flush())
+
+                        if process.wait() != 0:
+                            with open(stderr_path, 'r') as f:
+                                stderr = f.read()
+                            error_msg = f"pg_basebackup failed:\nCommand: {' '.join(pg_basebackup_cmd)}\nError: {stderr}"
+                            logger.error(error_msg)
+                            raise Exception(error_msg)
+                        writer.close()
+                    finally:
+                        writer.abort()
+                        if process is not None and process.poll() is None:
+                            process.kill()
+                            process.wait()
+                parts = [upload.result() for upload in uploads]
+            except Exception:
+                _discard_uploaded_parts(telegram_uploader, connection, uploads)
+                raise
+
+            with open(stderr_path, 'r') as f:
+                stderr = f.read()
+            logger.info(f"pg_basebackup output: {stderr}")
+
+        start_point = START_POINT_RE.search(stderr)
+        end_point = END_POINT_RE.search(stderr)
+        if not start_point:
+            raise Exception("Could not find the WAL start point in pg_basebackup output")
+        lsn_high, lsn_low, timeline = start_point.groups()
+
+        _add_index_entry(connection['id'], "base_backups", {
+            "name": backup_name,
+            "started_at": started_at,
+            "finished_at": datetime.now().strftime('%Y-%m-%dT%H:%M:%S'),
+            "timeline": int(timeline),
+            "start_lsn": f"{lsn_high}/{lsn_low}",
+            "end_lsn": end_point.group(1) if end_point else None,
+            "start_segment": lsn_to_segment(int(timeline), int(lsn_high, 16), int(lsn_low, 16)),
+            "parts": parts
+        })
+        update_last_run(connection)
+        return True
+
+    except Exception as e:
+        logger.error(f"Base backup failed for {connection['name']}: {str(e)}")
+        raise e
+
+
+class WalArchiver:
+    """Run pg_receivewal for a connection and upload WAL in bundles"""
+
+    def __init__(self, connection, telegram_uploader, default_chat_id):
+        self.connection = connection
+        self.telegram_uploader = telegram_uploader
+        self.default_chat_id = default_chat_id
+        self.wal_dir = os.path.join(WAL_DIR, connection['id'])
+        self.stop_event = threading.Event()
+        self.process = None
+        # Guards starting and terminating pg_receivewal against stop()
+        self.process_lock = threading.Lock()
+        self.threads = []
+
+    def _connection_args(self):
+        db_info = parse_db_url(self.connection['db_url'])
+        env = os.environ.copy()
+        env['PGPASSWORD'] = db_info['password']
+        args = [
+            '-h', db_info['host'],
+            '-p', str(db_info['port']),
+            '-U', db_info['user']
+        ]
+        if self.connection.get('wal_slot'):
+            args += ['--slot', self.connection['wal_slot']]
+        return args, env
+
+    def start(self):
+        os.makedirs(self.wal_dir, exist_ok=True)
+        self.threads = [
+            threading.Thread(target=self._run_receiver, daemon=True),
+            threading.Thread(target=self._run_bundler, daemon=True)
+        ]
+        for thread in self.threads:
+            thread.start()
+        logger.info(f"Started WAL archiving for {self.connection['name']}")
+
+    def stop(self):
+        self.stop_event.set()
+        with self.process_lock:
+            if self.process and self.process.poll() is None:
+                self.process.terminate()
+        # Wait for the final flush so a new archiver doesn't reupload the same files
+        for thread in self.threads:
+            thread.join()
+        logger.info(f"Stopped WAL archiving for {self.connection['name']}")
+
+    def _check_archive_timeout(self):
+        """Warn when the server may keep a segment open longer than WAL_BUNDLE_INTERVAL"""
+        try:
+            db_conn = psycopg2.connect(self.connection['db_url'])
+            try:
+                with db_conn.cursor() as cursor:
+                    cursor.execute("SELECT setting::int FROM pg_settings WHERE name = 'archive_timeout'")
+                    archive_timeout = cursor.fetchone()[0]
+            finally:
+                db_conn.close()
+        except Exception as e:
+            logger.warning(f"Could not read archive_timeout for {self.connection['name']}: {e}")
+            return
+        # Only finished segments are shipped, so archive_timeout bounds the data loss
+        if archive_timeout == 0 or archive_timeout > WAL_BUNDLE_INTERVAL:
+            logger.warning(
+                f"archive_timeout is {archive_timeout}s on {self.connection['name']}, "
+                f"set it to at most {WAL_BUNDLE_INTERVAL}s or WAL may stay unshipped for longer"
+            )
+
+    def _run_receiver(self):
+        self._check_archive_timeout()
+        args, env = self._connection_args()
+        if self.connection.get('wal_slot'):
+            result = subprocess.run(
+                ['pg_receivewal', *args, '--create-slot', '--if-not-exists'],
+                env=env,
+                capture_output=True,
+                text=True
+            )
+            if result.returncode != 0:
+                logger.error(f"Creating replication slot for {self.connection['name']} failed: {result.stderr}")
+
+        delay = 5
+        while not self.stop_event.is_set():
+            pg_receivewal_cmd = ['pg_receivewal', *args, '-D', self.wal_dir]
+            started = time.monotonic()
+            with self.process_lock:
+                # stop() may have run since the loop condition was checked
+                if self.stop_event.is_set():
+                    break
+                self.process = subprocess.Popen(
+                    pg_receivewal_cmd,
+                    env=env,
+                    stdout=subprocess.DEVNULL,
+                    stderr=subprocess.PIPE,
+                    text=True
+                )
+            _, stderr = self.process.communicate()
+            if self.stop_event.is_set():
+                break
+            logger.error(
+                f"pg_receivewal for {self.connection['name']} exited with code "
+                f"{self.process.returncode}: {stderr}"
+            )
+            if time.monotonic() - started > 300:
+                delay = 5
+            self.stop_event.wait(delay)
+            delay = min(delay * 2, 300)
+
+    def _run_bundler(self):
+        while not self.stop_event.wait(WAL_POLL_INTERVAL):
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"WAL bundle upload failed for {self.connection['name']}: {e}")
+        try:
+            self.flush(force=True)
+        except Exception as e:
+            logger.error(f"Final WAL bundle upload failed for {self.connection['name']}: {e}")
+
+    def _completed_files(self):
+        """Return completed WAL segments and history files, oldest first"""
+        return sorted(
+            name for name in os.listdir(self.wal_dir)
+            if WAL_SEGMENT_RE.match(name) or WAL_HISTORY_RE.match(name)
+        )
+
+    def _previous_last_write(self):
+        """Return the last write time of the newest uploaded WAL segment"""
+        conn_index = load_physical_index()["connections"].get(self.connection['id'], {})
+        for bundle in reversed(conn_index.get("wal_bundles", [])):
+            if bundle.get("last_segment"):
+                return bundle.get("last_write_at")
+        return None
+
+    def flush(self, force=False):
+        """Upload completed WAL files once the size or time threshold is hit"""
+        files = self._completed_files()
+        if not files:
+            return
+        paths = [os.path.join(self.wal_dir, name) for name in files]
+        total_size = sum(os.path.getsize(path) for path in paths)
+        oldest = min(os.path.getmtime(path) for path in paths)
+        if not force and total_size < WAL_BUNDLE_SIZE and time.time() - oldest < WAL_BUNDLE_INTERVAL:
+            return
+
+        segments = [name for name in files if WAL_SEGMENT_RE.match(name)]
+        closed_at = datetime.now().strftime('%Y-%m-%dT%H:%M:%S')
+        # A segment gets its first record once the previous one is finished,
+        # and its mtime is the time of its last write
+        first_write_at = self._previous_last_write() if segments else None
+        last_write_at = datetime.fromtimestamp(
+            os.path.getmtime(os.path.join(self.wal_dir, segments[-1]))
+        ).strftime('%Y-%m-%dT%H:%M:%S') if segments else None
+        if segments:
+            bundle_name = f"{self.connection['name']}_wal_{segments[0]}_{segments[-1]}.tar.gz"
+        else:
+            bundle_name = f"{self.connection['name']}_wal_history_{closed_at}.tar.gz"
+        chat_id, reply_to, added_by = get_upload_target(self.connection, self.default_chat_id)
+
+        os.makedirs(BACKUPS_DIR, exist_ok=True)
+        with tempfile.TemporaryDirectory(dir=BACKUPS_DIR) as temp_dir:
+            bundle_path = os.path.join(temp_dir, bundle_name)
+            with tarfile.open(bundle_path, 'w:gz') as tar:
+                for name, path in zip(files, paths):
+                    tar.add(path, arcname=name)
+            message = self.telegram_uploader.upload_file(
+                bundle_path,
+                chat_id,
+                caption=f"WAL for {self.connection['name']}: {len(segments)} segments closed at {closed_at}",
+                reply_to_message_id=reply_to,
+                added_by=added_by
+            )
+            bundle_size = os.path.getsize(bundle_path)
+
+        bundle_chat_id, message_id = _message_location(message)
+        _add_index_entry(self.connection['id'], "wal_bundles", {
+            "file": bundle_name,
+            "first_segment": segments[0] if segments else None,
+            "last_segment": segments[-1] if segments else None,
+            "files": files,
+            "size": bundle_size,
+            "closed_at": closed_at,
+            "first_write_at": first_write_at,
+            "last_write_at": last_write_at,
+            "chat_id": bundle_chat_id,
+            "message_id": message_id
+        })
+        for path in paths:
+            os.remove(path)
+        logger.info(f"Uploaded WAL bundle {bundle_name}")
+
+
+def _archiver_config(connection):
+    """Settings which require a restart of the archiver when changed"""
+    return tuple(
+        connection.get(key)
+        for key in ('name', 'db_url', 'chat_id', 'reply_to_message_id', 'wal_slot')
+    )
+
+def sync_wal_archivers(connections, telegram_uploader, default_chat_id):
+    """Start, restart or stop WAL archivers to match the physical connections"""
+    wanted = {
+        conn['id']: conn for conn in connections['connections']
+        if conn.get('backup_mode') == BACKUP_MODE_PHYSICAL
+    }
+    with _archivers_lock:
+        for connection_id in list(_archivers):
+            archiver = _archivers[connection_id]
+            connection = wanted.get(connection_id)
+            if connection is None or _archiver_config(connection) != _archiver_config(archiver.connection):
+                archiver.stop()
+                del _archivers[connection_id]
+
+        for connection_id, connection in wanted.items():
+            if connection_id not in _archivers:
+                archiver = WalArchiver(connection, telegram_uploader, default_chat_id)
+                archiver.start()
+                _archivers[connection_id] = archiver
+
+def stop_wal_archivers():
+    """Stop all running WAL archivers"""
+    with _archivers_lock:
+        for connection_id in list(_archivers):
+            _archivers.pop(connection_id).stop()
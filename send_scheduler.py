@@ -0,0 +1,323 @@
+import os
+import time
+import logging
+import threading
+from collections import deque
+from concurrent.futures import Future
+from typing import Optional
+
+from pyrogram.errors import FloodWait
+
+logger = logging.getLogger(__name__)
+
+# Telegram allows roughly 30 messages per second per bot and 20 messages
+# per minute per group, so the defaults stay a little below both limits.
+GLOBAL_RATE = float(os.getenv("TELEGRAM_GLOBAL_RATE", "25"))
+GLOBAL_BURST = int(os.getenv("TELEGRAM_GLOBAL_BURST", "30"))
+CHAT_RATE = float(os.getenv("TELEGRAM_CHAT_RATE", "0.33"))
+CHAT_BURST = int(os.getenv("TELEGRAM_CHAT_BURST", "3"))
+SEND_WORKERS = int(os.getenv("TELEGRAM_SEND_WORKERS", "2"))
+# Documents get their own workers so long uploads never hold up replies
+DOCUMENT_WORKERS = int(os.getenv("TELEGRAM_DOCUMENT_WORKERS", "2"))
+# Status texts sent within this many seconds are edited into one message
+STATUS_SUMMARY_WINDOW = int(os.getenv("TELEGRAM_STATUS_WINDOW", "60"))
+MAX_MESSAGE_LENGTH = 4096
+
+KIND_CALL = 'call'
+KIND_STATUS = 'status'
+
+LANE_MESSAGES = 'messages'
+LANE_DOCUMENTS = 'documents'
+
+
+class TokenBucket:
+    """Simple thread-safe token bucket"""
+
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated_at = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    def _refill(self, now: float):
+        elapsed = now - self.updated_at
+        self.tokens = min(self.capacity, self.tokens + elapsed * self.rate)
+        self.updated_at = now
+
+    def wait_time(self, now: Optional[float] = None) -> float:
+        """Return seconds until a token is available (0 if one is available now)"""
+        now = now if now is not None else time.monotonic()
+        with self.lock:
+            self._refill(now)
+            paused = max(0.0, self.paused_until - now)
+            if self.tokens >= 1:
+                return paused
+            return max(paused, (1 - self.tokens) / self.rate)
+
+    def pause(self, seconds: float):
+        """Hand out no tokens for the given number of seconds"""
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def consume(self, now: Optional[float] = None):
+        """Take one token, the caller must have checked wait_time() first"""
+        now = now if now is not None else time.monotonic()
+        with self.lock:
+            self._refill(now)
+            self.tokens -= 1
+
+
+class _Job:
+    def __init__(self, kind, chat_id, func=None, kwargs=None, text=None, lane=LANE_MESSAGES):
+        self.kind = kind
+        self.lane = lane
+        self.chat_id = chat_id
+        self.func = func
+        self.kwargs = kwargs or {}
+        self.text = text
+        self.future = Future()
+
+
+class SendScheduler:
+    """Central outbound queue for everything the bot sends to Telegram.
+
+    Jobs are queued per chat and executed in order for each chat, while
+    respecting a global and a per-chat token bucket. Documents run in their
+    own lane with separate workers, so messages and edits keep flowing
+    while large files upload. A FloodWait from Telegram pauses sending
+    instead of failing the job, and status texts that pile up for a chat
+    are merged into one summary message which gets edited as new statuses
+    arrive.
+    """
+
+    def __init__(self, client, workers: int = SEND_WORKERS,
+                 document_workers: int = DOCUMENT_WORKERS, logger=None):
+        self.client = client
+        self.logger = logger or logging.getLogger(__name__)
+        self.global_bucket = TokenBucket(GLOBAL_RATE, GLOBAL_BURST)
+        self.chat_buckets = {}
+        self.queues = {}
+        self.blocked_until = {}
+        self.busy_chats = set()
+        self.summaries = {}
+        self.stats = {
+            "sent": 0,
+            "failed": 0,
+            "flood_waits": 0,
+            "coalesced": 0,
+        }
+        self.condition = threading.Condition()
+        self.running = False
+        self.workers = [
+            threading.Thread(target=self._worker, args=(LANE_MESSAGES,), name=f"telegram-sender-{i}", daemon=True)
+            for i in range(max(1, workers))
+        ] + [
+            threading.Thread(target=self._worker, args=(LANE_DOCUMENTS,), name=f"telegram-uploader-{i}", daemon=True)
+            for i in range(max(1, document_workers))
+        ]
+
+    def start(self):
+        """Start the worker threads"""
+        if self.running:
+            return
+        self.running = True
+        for worker in self.workers:
+            worker.start()
+        self.logger.info(f"Send scheduler started with {len(self.workers)} workers")
+
+    def stop(self):
+        """Stop the worker threads, pending jobs are cancelled"""
+        with self.condition:
+            self.running = False
+            for queue in self.queues.values():
+                for job in queue:
+                    job.future.cancel()
+                queue.clear()
+            self.condition.notify_all()
+
+    # Public API
+
+    def submit(self, func, chat_id, **kwargs) -> Future:
+        """Queue func(chat_id=chat_id, **kwargs) and return its Future"""
+        return self._enqueue(_Job(KIND_CALL, chat_id, func=func, kwargs=kwargs))
+
+    def send_document(self, chat_id, **kwargs):
+        """Send a document and block until it is delivered"""
+        job = _Job(KIND_CALL, chat_id, func=self.client.send_document, kwargs=kwargs, lane=LANE_DOCUMENTS)
+        return self._enqueue(job).result()
+
+    def send_message(self, chat_id, text: str, **kwargs) -> Future:
+        """Queue a plain message"""
+        return self.submit(self.client.send_message, chat_id, text=text, **kwargs)
+
+    def edit_message_text(self, chat_id, message_id: int, text: str, **kwargs) -> Future:
+        """Queue an edit of an existing message"""
+        return self.submit(
+            self.client.edit_message_text,
+            chat_id,
+            message_id=message_id,
+            text=text,
+            **kwargs
+        )
+
+    def send_status(self, chat_id, text: str) -> Future:
+        """Queue a status text, which may be merged into the chat's summary message"""
+        return self._enqueue(_Job(KIND_STATUS, chat_id, text=text))
+
+    def metrics(self) -> dict:
+        """Return queue depth and delivery counters"""
+        with self.condition:
+            now = time.monotonic()
+            per_chat = {}
+            queued_documents = 0
+            for (lane, key), queue in self.queues.items():
+                if queue:
+                    per_chat[key] = per_chat.get(key, 0) + len(queue)
+                    if lane == LANE_DOCUMENTS:
+                        queued_documents += len(queue)
+            return {
+                "queued": sum(per_chat.values()),
+                "queued_documents": queued_documents,
+                "in_flight": len(self.busy_chats),
+                "per_chat": per_chat,
+                "flood_waited_chats": {
+                    key: round(until - now, 1)
+                    for key, until in self.blocked_until.items() if until > now
+                },
+                **self.stats,
+            }
+
+    # Internals
+
+    @staticmethod
+    def _key(chat_id):
+        return str(chat_id)
+
+    def _enqueue(self, job: _Job) -> Future:
+        with self.condition:
+            key = self._key(job.chat_id)
+            self.queues.setdefault((job.lane, key), deque()).append(job)
+            if key not in self.chat_buckets:
+                self.chat_buckets[key] = TokenBucket(CHAT_RATE, CHAT_BURST)
+            # Wake every worker, only those of the job's lane can take it
+            self.condition.notify_all()
+        return job.future
+
+    def _next_ready(self, lane):
+        """Pick a chat of the lane that can send now, or return how long to wait.
+
+        Must be called with the condition held.
+        """
+        now = time.monotonic()
+        wait = None
+        for queue_key, queue in self.queues.items():
+            queue_lane, key = queue_key
+            if queue_lane != lane or not queue or queue_key in self.busy_chats:
+                continue
+            delay = max(
+                self.blocked_until.get(key, 0) - now,
+                self.chat_buckets[key].wait_time(now),
+                self.global_bucket.wait_time(now),
+            )
+            if delay <= 0:
+                # Rotate so other chats get a turn on the next pick
+                self.queues[queue_key] = self.queues.pop(queue_key)
+                return queue_key, None
+            wait = delay if wait is None else min(wait, delay)
+        return None, wait
+
+    def _take_jobs(self, queue_key):
+        """Pop the head job, merging consecutive status texts for the chat"""
+        queue = self.queues[queue_key]
+        jobs = [queue.popleft()]
+        if jobs[0].kind == KIND_STATUS:
+            while queue and queue[0].kind == KIND_STATUS:
+                jobs.append(queue.popleft())
+            self.stats["coalesced"] += len(jobs) - 1
+        return jobs
+
+    def _worker(self, lane):
+        while True:
+            with self.condition:
+                while True:
+                    if not self.running:
+                        return
+                    queue_key, wait = self._next_ready(lane)
+                    if queue_key is not None:
+                        break
+                    self.condition.wait(wait)
+                key = queue_key[1]
+                jobs = self._take_jobs(queue_key)
+                self.busy_chats.add(queue_key)
+                now = time.monotonic()
+                self.global_bucket.consume(now)
+                self.chat_buckets[key].consume(now)
+
+            flood_wait = None
+            error = None
+            result = None
+            try:
+                result = self._execute(key, jobs)
+            except FloodWait as e:
+                flood_wait = e.value
+            except Exception as e:
+                error = e
+
+            with self.condition:
+                if flood_wait is not None:
+                    self.stats["flood_waits"] += 1
+                    self.blocked_until[key] = time.monotonic() + flood_wait
+                    # Flood limits can be bot-wide, so stop sending to other chats too
+                    self.global_bucket.pause(flood_wait)
+                    self.queues[queue_key].extendleft(reversed(jobs))
+                    self.logger.warning(
+                        f"FloodWait for chat {key}: pausing all sending for {flood_wait} seconds"
+                    )
+                elif error is not None:
+                    self.stats["failed"] += 1
+                    # Most callers never read the Future, so make failures visible here
+                    self.logger.error(f"Sending to chat {key} failed: {error}")
+                else:
+                    self.stats["sent"] += 1
+                self.busy_chats.discard(queue_key)
+                self.condition.notify_all()
+
+            if flood_wait is None:
+                for job in jobs:
+                    if error is not None:
+                        job.future.set_exception(error)
+                    else:
+                        job.future.set_result(result)
+
+    def _execute(self, key, jobs):
+        if jobs[0].kind == KIND_CALL:
+            job = jobs[0]
+            return job.func(chat_id=job.chat_id, **job.kwargs)
+        return self._send_summary(key, jobs)
+
+    def _send_summary(self, key, jobs):
+        chat_id = jobs[0].chat_id
+        text = "\n".join(job.text for job in jobs)
+
+        summary = self.summaries.get(key)
+        now = time.monotonic()
+        if summary and now - summary["started_at"] < STATUS_SUMMARY_WINDOW:
+            combined = f"{summary['text']}\n{text}"
+            if len(combined) <= MAX_MESSAGE_LENGTH:
+                message = self.client.edit_message_text(
+                    chat_id=chat_id,
+                    message_id=summary["message_id"],
+                    text=combined
+                )
+                summary["text"] = combined
+                return message
+
+        message = self.client.send_message(chat_id=chat_id, text=text[:MAX_MESSAGE_LENGTH])
+        self.summaries[key] = {
+            "message_id": message.id,
+            "text": text[:MAX_MESSAGE_LENGTH],
+            "started_at": now,
+        }
+        return message
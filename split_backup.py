@@ -0,0 +1,360 @@
+import os
+import re
+import json
+import zlib
+import hashlib
+import logging
+import tempfile
+import threading
+import subprocess
+from fnmatch import fnmatchcase
+from datetime import datetime, timedelta
+import psycopg2
+from psycopg2 import sql
+from utils import (
+    DATA_DIR,
+    BACKUPS_DIR,
+    PartWriter,
+    parse_db_url,
+    get_upload_target,
+    update_last_run
+)
+
+logger = logging.getLogger(__name__)
+
+SPLIT_CACHE_FILE = os.path.join(DATA_DIR, 'split_cache.json')
+
+# Table artifacts are split into parts below the Telegram bot upload limit
+SPLIT_PART_SIZE = int(os.getenv("SPLIT_PART_SIZE_MB", "1900")) * 1024 * 1024
+# Unchanged tables are dumped again once their artifact is this old
+SPLIT_CACHE_MAX_AGE = timedelta(days=int(os.getenv("SPLIT_CACHE_MAX_AGE_DAYS", "7")))
+CHUNK_SIZE = 1024 * 1024
+
+LIST_RELATIONS_QUERY = """
+    SELECT c.oid, n.nspname, c.relname, c.relkind
+    FROM pg_class c
+    JOIN pg_namespace n ON n.oid = c.relnamespace
+    WHERE c.relkind IN ('r', 'S')
+      AND n.nspname NOT IN ('pg_catalog', 'information_schema')
+      AND n.nspname NOT LIKE 'pg_toast%'
+      AND n.nspname NOT LIKE 'pg_temp%'
+    ORDER BY n.nspname, c.relname
+"""
+
+TABLE_STATS_QUERY = """
+    SELECT pg_relation_size(c.oid),
+           s.n_tup_ins,
+           s.n_tup_upd,
+           s.n_tup_del,
+           s.n_tup_hot_upd,
+           (
+               SELECT a.attname
+               FROM pg_index i
+               JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = i.indkey[0]
+               WHERE i.indrelid = c.oid AND i.indisprimary AND i.indnatts = 1
+           )
+    FROM pg_class c
+    LEFT JOIN pg_stat_user_tables s ON s.relid = c.oid
+    WHERE c.oid = %s
+"""
+
+# pg_dump 16.10+ wraps plain dumps in \restrict/\unrestrict lines with a
+# random key, which would make every dump hash differently
+RESTRICT_LINE_RE = re.compile(rb'^\\(?:un)?restrict [^\n]*\n', re.MULTILINE)
+
+_cache_lock = threading.Lock()
+
+
+def load_split_cache():
+    """Load the per-table artifact cache"""
+    try:
+        with open(SPLIT_CACHE_FILE, 'r') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+def _save_split_cache(connection_id, entries):
+    """Replace the cached artifacts of a connection"""
+    with _cache_lock:
+        cache = load_split_cache()
+        cache[connection_id] = entries
+        os.makedirs(DATA_DIR, exist_ok=True)
+        with open(SPLIT_CACHE_FILE, 'w') as f:
+            json.dump(cache, f, indent=4)
+
+def table_selected(name, include, exclude):
+    """Check a 'schema.table' name against include and exclude glob patterns"""
+    if include and not any(fnmatchcase(name, pattern) for pattern in include):
+        return False
+    return not any(fnmatchcase(name, pattern) for pattern in exclude or [])
+
+def _quote_pattern(schema, name):
+    """Quote a relation for pg_dump -t so it is matched literally"""
+    return '"{}"."{}"'.format(schema.replace('"', '""'), name.replace('"', '""'))
+
+def _table_fingerprint(cursor, oid, schema, table):
+    """Return a fingerprint which changes whenever a table's data changes.
+
+    Combines the relation size, the pg_stat modification counters and the
+    maximum primary key value for single column primary keys.
+    """
+    cursor.execute(TABLE_STATS_QUERY, (oid,))
+    size, inserted, updated, deleted, hot_updated, pk_column = cursor.fetchone()
+    max_pk = None
+    if pk_column:
+        cursor.execute(
+            sql.SQL("SELECT max({})::text FROM {}.{}").format(
+                sql.Identifier(pk_column),
+                sql.Identifier(schema),
+                sql.Identifier(table)
+            )
+        )
+        max_pk = cursor.fetchone()[0]
+    return [size, inserted, updated, deleted, hot_updated, max_pk]
+
+class _DumpDigest:
+    """sha256 of pg_dump output without the \\restrict/\\unrestrict lines"""
+
+    def __init__(self):
+        self.digest = hashlib.sha256()
+        self.pending = b''
+
+    def update(self, chunk):
+        # Only hash complete lines, so a restrict line split across chunks still matches
+        data = self.pending + chunk
+        end = data.rfind(b'\n') + 1
+        self.pending = data[end:]
+        self.digest.update(RESTRICT_LINE_RE.sub(b'', data[:end]))
+
+    def hexdigest(self):
+        self.digest.update(RESTRICT_LINE_RE.sub(b'', self.pending + b'\n'))
+        return self.digest.hexdigest()
+
+def _dump(pg_dump_cmd, env, base_path):
+    """Run pg_dump, gzip its output into parts and return (paths, sha256)"""
+    paths = []
+    digest = _DumpDigest()
+    writer = PartWriter(base_path, SPLIT_PART_SIZE, lambda path, number: paths.append(path))
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    with tempfile.TemporaryFile() as stderr_file:
+        process = subprocess.Popen(
+            pg_dump_cmd,
+            env=env,
+            stdout=subprocess.PIPE,
+            stderr=stderr_file
+        )
+        try:
+            for chunk in iter(lambda: process.stdout.read(CHUNK_SIZE), b''):
+                digest.update(chunk)
+                writer.write(compressor.compress(chunk))
+            writer.write(compressor.flush())
+            if process.wait() != 0:
+                stderr_file.seek(0)
+                error_msg = (
+                    f"pg_dump failed:\nCommand: {' '.join(pg_dump_cmd)}\n"
+                    f"Error: {stderr_file.read().decode(errors='replace')}"
+                )
+                logger.error(error_msg)
+                raise Exception(error_msg)
+            writer.close()
+        finally:
+            writer.abort()
+            if process.poll() is None:
+                process.kill()
+                process.wait()
+    return paths, digest.hexdigest()
+
+def _upload_parts(telegram_uploader, paths, caption, chat_id, reply_to, added_by):
+    """Upload artifact parts and return their index entries"""
+    parts = []
+    for number, path in enumerate(paths, start=1):
+        message = telegram_uploader.upload_file(
+            path,
+            chat_id,
+            caption=caption if len(paths) == 1 else f"{caption} (part {number})",
+            reply_to_message_id=reply_to,
+            added_by=added_by
+        )
+        parts.append({
+            "file": os.path.basename(path),
+            "size": os.path.getsize(path),
+            "chat_id": message.chat.id if message else None,
+            "message_id": message.id if message else None
+        })
+        os.remove(path)
+    return parts
+
+
+def split_backup_database(connection, telegram_uploader, default_chat_id):
+    """Dump the schema and every table of a connection as separate artifacts.
+
+    All dumps share one exported snapshot, which is released before any
+    upload starts. Tables whose fingerprint matches the cache reuse the
+    artifact that was already uploaded, and a manifest listing every
+    artifact in restore order is uploaded last.
+    """
+    db_conn = None
+    try:
+        db_info = parse_db_url(connection['db_url'])
+        timestamp = datetime.now().strftime('%Y-%m-%dT%H:%M:%S')
+        chat_id, reply_to, added_by = get_upload_target(connection, default_chat_id)
+        include = connection.get('split_include') or []
+        exclude = connection.get('split_exclude') or []
+        cached = load_split_cache().get(connection['id'], {})
+
+        logger.info(f"Starting split backup for database: {connection['name']}")
+        db_conn = psycopg2.connect(connection['db_url'])
+        db_conn.autocommit = True
+        cursor = db_conn.cursor()
+
+        cursor.execute(LIST_RELATIONS_QUERY)
+        tables = []
+        sequences = []
+        for oid, schema, name, relkind in cursor.fetchall():
+            if relkind == 'S':
+                sequences.append((schema, name))
+            elif table_selected(f"{schema}.{name}", include, exclude):
+                tables.append((oid, schema, name))
+
+        # pg_stat counters stay at zero on a hot standby, so fingerprints
+        # can't see changes there and every table is dumped and hashed
+        cursor.execute("SELECT pg_is_in_recovery()")
+        in_recovery = cursor.fetchone()[0]
+        if in_recovery:
+            logger.info(f"{connection['name']} is a standby, comparing table contents instead of fingerprints")
+
+        # Fingerprints are taken before the snapshot, so a change that
+        # races the snapshot shows up as a new fingerprint on the next run
+        fingerprints = {
+            f"{schema}.{name}": None if in_recovery else _table_fingerprint(cursor, oid, schema, name)
+            for oid, schema, name in tables
+        }
+
+        db_conn.autocommit = False
+        db_conn.set_session(isolation_level='REPEATABLE READ', readonly=True)
+        cursor.execute("SELECT pg_export_snapshot()")
+        snapshot_id = cursor.fetchone()[0]
+        # pg_dump leaves large objects out of -t and --schema-only dumps
+        cursor.execute("SELECT EXISTS (SELECT 1 FROM pg_largeobject_metadata)")
+        has_large_objects = cursor.fetchone()[0]
+
+        env = os.environ.copy()
+        env['PGPASSWORD'] = db_info['password']
+        base_cmd = [
+            'pg_dump',
+            '-h', db_info['host'],
+            '-p', str(db_info['port']),
+            '-U', db_info['user'],
+            '-d', db_info['database'],
+            f'--snapshot={snapshot_id}'
+        ]
+
+        os.makedirs(BACKUPS_DIR, exist_ok=True)
+        new_cache = {}
+        artifacts = []
+        now = datetime.now()
+
+        with tempfile.TemporaryDirectory(dir=BACKUPS_DIR) as temp_dir:
+            dumps = []
+
+            def dump_artifact(key, kind, pg_dump_args, fingerprint=None):
+                previous = cached.get(key)
+
+                # Tables with an unchanged fingerprint are not dumped at all
+                if (
+                    fingerprint is not None and previous
+                    and previous["fingerprint"] == fingerprint
+                    and now - datetime.strptime(
+                        previous.get("verified_at", previous["uploaded_at"]), '%Y-%m-%dT%H:%M:%S'
+                    ) < SPLIT_CACHE_MAX_AGE
+                ):
+                    dumps.append((key, kind, previous, None, None, fingerprint))
+                    return
+
+                file_name = f"{connection['name']}_{key}_{timestamp}.sql.gz"
+                paths, content_hash = _dump(base_cmd + pg_dump_args, env, os.path.join(temp_dir, file_name))
+                dumps.append((key, kind, previous, paths, content_hash, fingerprint))
+
+            # Artifacts are dumped in restore order
+            dump_artifact("pre-data", "schema", ['--schema-only', '--section=pre-data'])
+            for oid, schema, name in tables:
+                key = f"{schema}.{name}"
+                dump_artifact(key, "table", ['--data-only', '-t', _quote_pattern(schema, name)], fingerprints[key])
+            if sequences:
+                sequence_args = ['--data-only']
+                for schema, name in sequences:
+                    sequence_args += ['-t', _quote_pattern(schema, name)]
+                dump_artifact("sequences", "sequences", sequence_args)
+            if has_large_objects:
+                # Large objects only, with their lo_create, owner and ACL entries
+                dump_artifact("large-objects", "large-objects", ['--data-only', '--blobs', '--exclude-table-data=*.*'])
+            dump_artifact("post-data", "schema", ['--schema-only', '--section=post-data'])
+
+            # Release the snapshot before uploading, so slow uploads don't
+            # hold back vacuum on the database
+            db_conn.rollback()
+            db_conn.close()
+            db_conn = None
+
+            for key, kind, previous, paths, content_hash, fingerprint in dumps:
+                if paths is None:
+                    new_cache[key] = previous
+                    artifacts.append({"name": key, "kind": kind, "reused": True, "parts": previous["parts"]})
+                    continue
+
+                # Dumped artifacts are only uploaded when their content changed
+                if previous and previous.get("content_hash") == content_hash:
+                    new_cache[key] = {**previous, "fingerprint": fingerprint, "verified_at": timestamp}
+                    artifacts.append({"name": key, "kind": kind, "reused": True, "parts": previous["parts"]})
+                    continue
+
+                parts = _upload_parts(
+                    telegram_uploader,
+                    paths,
+                    f"{kind.capitalize()} {key} of {connection['name']} at {timestamp}",
+                    chat_id,
+                    reply_to,
+                    added_by
+                )
+                new_cache[key] = {
+                    "fingerprint": fingerprint,
+                    "content_hash": content_hash,
+                    "uploaded_at": timestamp,
+                    "verified_at": timestamp,
+                    "parts": parts
+                }
+                artifacts.append({"name": key, "kind": kind, "reused": False, "parts": parts})
+
+        reused_count = sum(1 for artifact in artifacts if artifact["reused"])
+        with tempfile.TemporaryDirectory(dir=BACKUPS_DIR) as temp_dir:
+            manifest_path = os.path.join(temp_dir, f"{connection['name']}_manifest_{timestamp}.json")
+            with open(manifest_path, 'w') as f:
+                json.dump({
+                    "connection": connection['name'],
+                    "created_at": timestamp,
+                    "include": include,
+                    "exclude": exclude,
+                    "artifacts": artifacts
+                }, f, indent=4)
+            telegram_uploader.upload_file(
+                manifest_path,
+                chat_id,
+                caption=(
+                    f"Split backup for {connection['name']} completed at {timestamp}\n"
+                    f"Artifacts: {len(artifacts)}, reused: {reused_count}"
+                ),
+                reply_to_message_id=reply_to,
+                added_by=added_by
+            )
+
+        _save_split_cache(connection['id'], new_cache)
+        update_last_run(connection)
+        return True
+
+    except Exception as e:
+        logger.error(f"Split backup failed for {connection['name']}: {str(e)}")
+        raise e
+    finally:
+        if db_conn is not None:
+            db_conn.close()
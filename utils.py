@@ -19,6 +19,12 @@ logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s
 # Define data directory path
 DATA_DIR = './data'
 CONNECTIONS_FILE = os.path.join(DATA_DIR, 'connections.json')
+BACKUPS_DIR = os.path.join(DATA_DIR, 'backups')
+
+BACKUP_MODE_LOGICAL = 'logical'
+BACKUP_MODE_PHYSICAL = 'physical'
+BACKUP_MODE_SPLIT = 'split'
+BACKUP_MODES = (BACKUP_MODE_LOGICAL, BACKUP_MODE_PHYSICAL, BACKUP_MODE_SPLIT)
 
 def ensure_data_dir():
     """Ensure data directory and connections.json exist"""
@@ -128,8 +134,87 @@ def mask_db_url(db_url):
     except:
         return db_url
 
+class PartWriter:
+    """Write a byte stream into numbered part files of a maximum size"""
+
+    def __init__(self, base_path, part_size, on_part):
+        self.base_path = base_path
+        self.part_size = part_size
+        self.on_part = on_part
+        self.number = 0
+        self.file = None
+        self.path = None
+        self.written = 0
+
+    def _open(self):
+        self.number += 1
+        self.path = f"{self.base_path}.part{self.number:03d}"
+        self.file = open(self.path, 'wb')
+        self.written = 0
+
+    def write(self, data):
+        while data:
+            if self.file is None:
+                self._open()
+            chunk = data[:self.part_size - self.written]
+            self.file.write(chunk)
+            self.written += len(chunk)
+            data = data[len(chunk):]
+            if self.written >= self.part_size:
+                self.file.close()
+                self.file = None
+                self.on_part(self.path, self.number)
+
+    def close(self):
+        if self.file is None:
+            return
+        self.file.close()
+        self.file = None
+        # A backup that fits in one part keeps its plain name
+        if self.number == 1:
+            os.rename(self.path, self.base_path)
+            self.path = self.base_path
+        self.on_part(self.path, self.number)
+
+    def abort(self):
+        """Close and remove the part being written, without handing it on"""
+        if self.file is None:
+            return
+        self.file.close()
+        self.file = None
+        os.remove(self.path)
+
+def get_upload_target(connection, default_chat_id):
+    """Return (chat_id, reply_to_message_id, added_by) for a connection"""
+    chat_id = connection.get('chat_id') or default_chat_id
+    reply_to = connection.get('reply_to_message_id')
+    reply_to = int(reply_to) if reply_to else None
+    added_by = connection.get('added_by', default_chat_id)
+    return chat_id, reply_to, added_by
+
+def update_last_run(connection):
+    """Store the current time as last_run_at of a connection"""
+    connections = load_connections()
+    try:
+        for conn in connections['connections']:
+            if conn['id'] == connection['id']:
+                conn['last_run_at'] = datetime.now().strftime('%Y-%m-%dT%H:%M:%S')
+                save_connections(connections)
+                break
+    except Exception as e:
+        logger.error('Error in reading files')
+        time.sleep(random.random() * 2)
+
 def backup_database(connection, telegram_uploader, default_chat_id):
     """Execute database backup for a given connection"""
+    if connection.get('backup_mode', BACKUP_MODE_LOGICAL) == BACKUP_MODE_PHYSICAL:
+        # Imported here since physical_backup depends on this module
+        from physical_backup import basebackup_database
+        return basebackup_database(connection, telegram_uploader, default_chat_id)
+    if connection.get('backup_mode') == BACKUP_MODE_SPLIT:
+        from split_backup import split_backup_database
+        return split_backup_database(connection, telegram_uploader, default_chat_id)
+
     try:
         
         # Parse database URL and prepare backup
@@ -180,27 +265,17 @@ def backup_database(connection, telegram_uploader, default_chat_id):
                     f_out.writelines(f_in)
             
             # Upload to Telegram
-            chat_id = connection.get('chat_id', default_chat_id)
-            reply_to = int(connection.get('reply_to_message_id'))
+            chat_id, reply_to, added_by = get_upload_target(connection, default_chat_id)
             telegram_uploader.upload_file(
                 compressed_path,
                 chat_id,
                 caption=f"Backup for {connection['name']} completed at {timestamp}",
                 reply_to_message_id=reply_to,
-                added_by=connection.get('added_by', default_chat_id)
+                added_by=added_by
             )
 
         # Update last run timestamp
-        connections = load_connections()
-        try:
-            for conn in connections['connections']:
-                if conn['id'] == connection['id']:
-                    conn['last_run_at'] = datetime.now().strftime('%Y-%m-%dT%H:%M:%S')
-                    save_connections(connections)
-                    break
-        except Exception as e:
-            logger.error('Error in reading files')
-            time.sleep(random.random() * 2)
+        update_last_run(connection)
             
         return True
             
@@ -231,6 +306,10 @@ def initialize_scheduler(scheduler, connections, backup_callback, telegram_uploa
             replace_existing=True
         )
         logger.info(f"Scheduled backup job for {connection['name']} with schedule: {connection['cron_schedule']}")
+
+    # Start or stop continuous WAL archiving for physical connections
+    from physical_backup import sync_wal_archivers
+    sync_wal_archivers(connections, telegram_uploader, CHAT_ID)
     
     # Start the scheduler if it's not already running
     if not scheduler.running: